@@ -1,10 +1,14 @@
+import torch
 from torch.utils.data import Dataset
 import linecache
+import mmap
 import os
 import numpy as np
 
 from .utils.process_utils import base2code_dna
 
+_INT16_MAX = np.iinfo(np.int16).max
+
 
 def clear_linecache():
     # linecache should be treated carefully
@@ -22,9 +26,10 @@ def parse_a_line2(line):
     sampleinfo = "\t".join(words[0:6])
 
     kmer = np.array([base2code_dna[x] for x in words[6]])
-    base_means = np.array([float(x) for x in words[7].split(",")])
-    base_stds = np.array([float(x) for x in words[8].split(",")])
-    base_signal_lens = np.array([int(x) for x in words[9].split(",")])
+    # float32 (as FloatTensor in call_mods) and int16, instead of float64/int64, to reduce host->device bytes
+    base_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float32)
+    base_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float32)
+    base_signal_lens = np.array([min(int(x), _INT16_MAX) for x in words[9].split(",")], dtype=np.int16)
     k_signals = np.array([[float(y) for y in x.split(",")] for x in words[10].split(";")])
     label = int(words[11])
 
@@ -33,24 +38,89 @@ def parse_a_line2(line):
 
 class SignalFeaData2(Dataset):
     def __init__(self, filename, transform=None):
-        print(">>>using linecache to access '{}'<<<\n"
-              ">>>after done using the file, "
-              "remember to use linecache.clearcache() to clear cache for safety<<<".format(filename))
+        print(">>>using mmap to access '{}'<<<".format(filename))
         self._filename = os.path.abspath(filename)
-        self._total_data = 0
         self._transform = transform
-        with open(filename, "r") as f:
-            self._total_data = len(f.readlines())
+        self._mm = None
+        # byte offset of each line, lines are then sliced from a read-only mmap of the file instead of
+        # caching the whole file in memory (once per DataLoader worker, as linecache does)
+        offsets = [0]
+        with open(self._filename, "rb") as f:
+            for line in f:
+                offsets.append(offsets[-1] + len(line))
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._total_data = len(offsets) - 1
+
+    def _get_mmap(self):
+        # opened lazily in each process, all workers share the same page cache
+        if self._mm is None:
+            with open(self._filename, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def __getstate__(self):
+        # mmap objects can not be pickled (spawned DataLoader workers), reopen in the worker
+        state = self.__dict__.copy()
+        state["_mm"] = None
+        return state
 
     def __getitem__(self, idx):
-        line = linecache.getline(self._filename, idx + 1)
-        if line == "":
+        if idx >= self._total_data:
             return None
-        else:
-            output = parse_a_line2(line)
-            if self._transform is not None:
-                output = self._transform(output)
-            return output
+        line = self._get_mmap()[self._offsets[idx]:self._offsets[idx + 1]].decode()
+        output = parse_a_line2(line)
+        if self._transform is not None:
+            output = self._transform(output)
+        return output
 
     def __len__(self):
         return self._total_data
+
+
+class SignalBatch(object):
+    """
+    a batch of samples from SignalFeaData2, pinned and moved to device as a whole
+    """
+    def __init__(self, sampleinfo, kmer, base_means, base_stds, base_signal_lens, signals, labels):
+        self.sampleinfo = sampleinfo
+        self.kmer = kmer
+        self.base_means = base_means
+        self.base_stds = base_stds
+        self.base_signal_lens = base_signal_lens
+        self.signals = signals
+        self.labels = labels
+
+    def _apply(self, func):
+        return SignalBatch(self.sampleinfo, func(self.kmer), func(self.base_means), func(self.base_stds),
+                           func(self.base_signal_lens), func(self.signals), func(self.labels))
+
+    def pin_memory(self):
+        # called by DataLoader(pin_memory=True) in its pin thread
+        return self._apply(lambda x: x.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return self._apply(lambda x: x.to(device, non_blocking=non_blocking))
+
+    def __iter__(self):
+        return iter((self.sampleinfo, self.kmer, self.base_means, self.base_stds,
+                     self.base_signal_lens, self.signals, self.labels))
+
+    def __len__(self):
+        return len(self.sampleinfo)
+
+
+def signal_collate(samples):
+    """
+    collate_fn of SignalFeaData2, stacks each feature of the samples into one tensor
+    :param samples: list of outputs of parse_a_line2
+    :return: SignalBatch
+    """
+    sampleinfo, kmer, base_means, base_stds, base_signal_lens, k_signals, label = zip(*samples)
+    return SignalBatch(list(sampleinfo),
+                       torch.from_numpy(np.stack(kmer)),
+                       torch.from_numpy(np.stack(base_means)),
+                       torch.from_numpy(np.stack(base_stds)),
+                       torch.from_numpy(np.stack(base_signal_lens)),
+                       # (N, seq_len, signal_len), the contiguous (N, L, C) layout of the batch_first lstm_signal
+                       torch.from_numpy(np.ascontiguousarray(np.stack(k_signals), dtype=np.float32)),
+                       torch.tensor(label, dtype=torch.long))
@@ -1,10 +1,12 @@
 #!/usr/bin/python
 from __future__ import absolute_import
 
+import os
 import sys
 import argparse
 
 from .utils.process_utils import str2bool
+from .utils.process_utils import positive_int
 from .utils.process_utils import display_args
 
 from ._version import DEEPSIGNAL_PLANT_VERSION
@@ -360,6 +362,12 @@ def main():
                           required=False, help="type of optimizer to use, 'Adam' or 'SGD' or 'RMSprop' or 'Ranger', "
                                                "default Adam")
     st_train.add_argument('--batch_size', type=int, default=512, required=False)
+    st_train.add_argument('--valid_batch_size', type=int, default=None, required=False,
+                          help="batch size of validation, no gradients are kept in validation so it can be larger "
+                               "than --batch_size. default the same as --batch_size")
+    st_train.add_argument('--grad_accum_steps', type=positive_int, default=1, required=False,
+                          help="number of batches to accumulate gradients over before each optimizer step, "
+                               "the effective batch size is batch_size*grad_accum_steps. default 1")
     st_train.add_argument('--lr', type=float, default=0.001, required=False)
     st_train.add_argument('--lr_decay', type=float, default=0.1, required=False)
     st_train.add_argument('--lr_decay_step', type=int, default=2, required=False)
@@ -368,8 +376,24 @@ def main():
     st_train.add_argument("--min_epoch_num", action="store", default=5, type=int,
                           required=False, help="min epoch num, default 5")
     st_train.add_argument('--step_interval', type=int, default=100, required=False)
+    st_train.add_argument('--valid_steps_per_check', type=int, default=20, required=False,
+                          help="size (in batches) of the random valid subset, sampled once at start, used in "
+                               "each check every step_interval steps. the whole valid set is used at the end of "
+                               "each epoch. 0 for the whole valid set in each check, default 20")
+    st_train.add_argument('--num_workers', type=int, default=min(8, os.cpu_count() or 1), required=False,
+                          help="number of subprocesses used by DataLoader, default min(8, cpu_count)")
+    st_train.add_argument('--prefetch_factor', type=int, default=4, required=False,
+                          help="number of batches loaded in advance by each DataLoader worker, default 4")
 
     st_train.add_argument('--pos_weight', type=float, default=1.0, required=False)
+    st_train.add_argument('--use_compile', type=str, default="no", required=False,
+                          help="use torch.compile on the model for training (needs torch>=2.0 and GPU, "
+                               "not available in the torch range of requirements.txt), default no")
+    st_train.add_argument('--jit_eval', type=str, default="no", required=False,
+                          help="use a TorchScript copy of the model for validation, default no")
+    st_train.add_argument('--use_amp', type=str, default="yes", required=False,
+                          help="use automatic mixed precision (bf16 if supported, else fp16) when training "
+                               "on GPU, default yes")
     # st_train.add_argument('--seed', type=int, default=1234,
     #                        help='random seed')
     # else
@@ -86,13 +86,11 @@ def train_1time(train_file, valid_file, valid_lidxs, args):
             if (i + 1) % args.step_interval == 0:
                 _, tpredicted = torch.max(tlogits.data, 1)
 
-                tlabels = labels
-                if use_cuda:
-                    tlabels = labels.cpu()
-                    tpredicted = tpredicted.cpu()
-                i_accuracy = metrics.accuracy_score(tlabels.numpy(), tpredicted)
-                i_precision = metrics.precision_score(tlabels.numpy(), tpredicted)
-                i_recall = metrics.recall_score(tlabels.numpy(), tpredicted)
+                y_true = labels.cpu().numpy()
+                y_pred = tpredicted.cpu().numpy()
+                i_accuracy = metrics.accuracy_score(y_true, y_pred)
+                i_precision = metrics.precision_score(y_true, y_pred)
+                i_recall = metrics.recall_score(y_true, y_pred)
 
                 test_accus.append(i_accuracy)
 
@@ -116,7 +114,9 @@ def train_1time(train_file, valid_file, valid_lidxs, args):
     total_step = len(valid_loader)
     print("valid total_step: {}".format(total_step))
     model.eval()
-    vlosses, vaccus, vprecs, vrecas = [], [], [], []
+    # labels/predictions of the whole valid set, metrics are computed once after the loop
+    vlabels_total = np.zeros(len(valid_dataset), dtype=np.int64)
+    vpredicted_total = np.zeros(len(valid_dataset), dtype=np.int64)
     lineidx_cnt = 0
     idx2aclogits = {}
     start = time.time()
@@ -135,24 +135,19 @@ def train_1time(train_file, valid_file, valid_lidxs, args):
 
         _, vpredicted = torch.max(vlogits.data, 1)
 
-        if use_cuda:
-            vlabels = vlabels.cpu()
-            vpredicted = vpredicted.cpu()
-            vlogits = vlogits.cpu()
+        y_true = vlabels.cpu().numpy()
+        y_pred = vpredicted.cpu().numpy()
+        vlabels_total[lineidx_cnt:lineidx_cnt + len(y_true)] = y_true
+        vpredicted_total[lineidx_cnt:lineidx_cnt + len(y_true)] = y_pred
 
-        for alogit in vlogits.detach().numpy():
+        for alogit in vlogits.detach().cpu().numpy():
             idx2aclogits[valid_lidxs[lineidx_cnt]] = alogit[1]
             lineidx_cnt += 1
 
-        i_accuracy = metrics.accuracy_score(vlabels.numpy(), vpredicted)
-        i_precision = metrics.precision_score(vlabels.numpy(), vpredicted)
-        i_recall = metrics.recall_score(vlabels.numpy(), vpredicted)
-
-        vaccus.append(i_accuracy)
-        vprecs.append(i_precision)
-        vrecas.append(i_recall)
-
         if (vi + 1) % args.step_interval == 0:
+            i_accuracy = metrics.accuracy_score(y_true, y_pred)
+            i_precision = metrics.precision_score(y_true, y_pred)
+            i_recall = metrics.recall_score(y_true, y_pred)
             endtime = time.time()
             print('===Test, Step [{}/{}], ValidLoss: {:.4f}, '
                   'Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}, '
@@ -161,9 +156,12 @@ def train_1time(train_file, valid_file, valid_lidxs, args):
             sys.stdout.flush()
             start = time.time()
 
-    print("===Test, Total Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}".format(np.mean(vaccus),
-                                                                                      np.mean(vprecs),
-                                                                                      np.mean(vrecas)))
+    vlabels_total = vlabels_total[:lineidx_cnt]
+    vpredicted_total = vpredicted_total[:lineidx_cnt]
+    print("===Test, Total Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}".format(
+        metrics.accuracy_score(vlabels_total, vpredicted_total),
+        metrics.precision_score(vlabels_total, vpredicted_total),
+        metrics.recall_score(vlabels_total, vpredicted_total)))
     del model
     # treat linecache carefully
     clear_linecache()
@@ -3,16 +3,15 @@
 
 from __future__ import absolute_import
 
+from typing import List, Tuple
+
 import torch
 import torch.nn as nn
-import torch.autograd as autograd
 import torch.nn.functional as F
 
 import torch.utils
 import torch.utils.checkpoint
 
-from .utils.constants_torch import use_cuda
-
 
 # inner module ================================================
 # https://github.com/kuangliu/pytorch-cifar/blob/master/models/resnet.py
@@ -116,22 +115,30 @@ class ModelBiLSTM(nn.Module):
 
         self.hidden_size = hidden_size
 
+        # every attribute is defined for every module type (None for the unused feature), so that
+        # torch.jit.script can resolve the "is not None" branches in forward
         if self.module == "both_bilstm":
             self.nhid_seq = self.hidden_size // 2
             self.nhid_signal = self.hidden_size - self.nhid_seq
         elif self.module == "seq_bilstm":
             self.nhid_seq = self.hidden_size
+            self.nhid_signal = 0
         elif self.module == "signal_bilstm":
+            self.nhid_seq = 0
             self.nhid_signal = self.hidden_size
         else:
             raise ValueError("--model_type is not right!")
 
         # seq feature
+        self.is_base = is_base
+        self.is_signallen = is_signallen
+        self.sigfea_num = 3 if self.is_signallen else 2
+        self.embed = None
+        self.lstm_seq = None
+        self.fc_seq = None
+        self.relu_seq = None
         if self.module != "signal_bilstm":
             self.embed = nn.Embedding(vocab_size, embedding_size)  # for dna/rna base
-            self.is_base = is_base
-            self.is_signallen = is_signallen
-            self.sigfea_num = 3 if self.is_signallen else 2
             if is_base:
                 self.lstm_seq = nn.LSTM(embedding_size + self.sigfea_num, self.nhid_seq, self.num_layers2,
                                         dropout=dropout_rate, batch_first=True, bidirectional=True)
@@ -143,6 +150,9 @@ class ModelBiLSTM(nn.Module):
             self.relu_seq = nn.ReLU()
 
         # signal feature
+        self.lstm_signal = None
+        self.fc_signal = None
+        self.relu_signal = None
         if self.module != "seq_bilstm":
             # self.convs = ResNet3(self.nhid_signal, (1, 1, 1), self.signal_len, self.signal_len)  # (N, C, L)
             self.lstm_signal = nn.LSTM(self.signal_len, self.nhid_signal, self.num_layers2,
@@ -162,69 +172,110 @@ class ModelBiLSTM(nn.Module):
         self.relu = nn.ReLU()
         self.softmax = nn.Softmax(1)
 
+        # cuda streams for running seq and signal features in parallel, created at the first forward on GPU
+        self._streams = None
+
     def get_model_type(self):
         return self.model_type
 
-    def init_hidden(self, batch_size, num_layers, hidden_size):
-        # Set initial states
-        h0 = autograd.Variable(torch.randn(num_layers * 2, batch_size, hidden_size))
-        c0 = autograd.Variable(torch.randn(num_layers * 2, batch_size, hidden_size))
-        if use_cuda:
-            h0 = h0.cuda()
-            c0 = c0.cuda()
+    def init_hidden(self, batch_size: int, num_layers: int, hidden_size: int, device: torch.device):
+        # Set initial states, created directly on the device of the inputs
+        h0 = torch.randn(num_layers * 2, batch_size, hidden_size, device=device)
+        c0 = torch.randn(num_layers * 2, batch_size, hidden_size, device=device)
         return h0, c0
 
-    def forward(self, kmer, base_means, base_stds, base_signal_lens, signals):
-        # seq feature ============================================
+    def _seq_forward(self, kmer, base_means, base_stds, base_signal_lens):
         # kmer, base_means, base_stds, base_signal_lens
-        if self.module != "signal_bilstm":
-            base_means = torch.reshape(base_means, (-1, self.seq_len, 1)).float()
-            base_stds = torch.reshape(base_stds, (-1, self.seq_len, 1)).float()
-            base_signal_lens = torch.reshape(base_signal_lens, (-1, self.seq_len, 1)).float()
-            if self.is_base:
-                kmer_embed = self.embed(kmer.long())
-                if self.is_signallen:
-                    out_seq = torch.cat((kmer_embed, base_means, base_stds, base_signal_lens), 2)  # (N, L, C)
-                else:
-                    out_seq = torch.cat((kmer_embed, base_means, base_stds), 2)  # (N, L, C)
+        base_means = torch.reshape(base_means, (-1, self.seq_len, 1)).float()
+        base_stds = torch.reshape(base_stds, (-1, self.seq_len, 1)).float()
+        base_signal_lens = torch.reshape(base_signal_lens, (-1, self.seq_len, 1)).float()
+        if self.is_base:
+            kmer_embed = self.embed(kmer.long())
+            if self.is_signallen:
+                out_seq = torch.cat((kmer_embed, base_means, base_stds, base_signal_lens), 2)  # (N, L, C)
+            else:
+                out_seq = torch.cat((kmer_embed, base_means, base_stds), 2)  # (N, L, C)
+        else:
+            if self.is_signallen:
+                out_seq = torch.cat((base_means, base_stds, base_signal_lens), 2)  # (N, L, C)
             else:
-                if self.is_signallen:
-                    out_seq = torch.cat((base_means, base_stds, base_signal_lens), 2)  # (N, L, C)
-                else:
-                    out_seq = torch.cat((base_means, base_stds), 2)  # (N, L, C)
-            out_seq, _ = self.lstm_seq(out_seq, self.init_hidden(out_seq.size(0),
-                                                                 self.num_layers2,
-                                                                 self.nhid_seq))  # (N, L, nhid_seq*2)
-            out_seq = self.fc_seq(out_seq)  # (N, L, nhid_seq)
-            # out_seq = self.dropout_seq(out_seq)
-            out_seq = self.relu_seq(out_seq)
+                out_seq = torch.cat((base_means, base_stds), 2)  # (N, L, C)
+        out_seq, _ = self.lstm_seq(out_seq, self.init_hidden(out_seq.size(0),
+                                                             self.num_layers2,
+                                                             self.nhid_seq,
+                                                             out_seq.device))  # (N, L, nhid_seq*2)
+        out_seq = self.fc_seq(out_seq)  # (N, L, nhid_seq)
+        # out_seq = self.dropout_seq(out_seq)
+        out_seq = self.relu_seq(out_seq)
+        return out_seq
+
+    def _signal_forward(self, signals):
+        # sgianls (L*C)
+        out_signal = signals.float()
+        # resnet ---
+        # out_signal = out_signal.transpose(1, 2)  # (N, C, L)
+        # out_signal = self.convs(out_signal)  # (N, nhid_signal, L)
+        # out_signal = out_signal.transpose(1, 2)  # (N, L, nhid_signal)
+        # lstm ---
+        out_signal, _ = self.lstm_signal(out_signal, self.init_hidden(out_signal.size(0),
+                                                                      self.num_layers2,
+                                                                      self.nhid_signal,
+                                                                      out_signal.device))
+        out_signal = self.fc_signal(out_signal)  # (N, L, nhid_signal)
+        # out_signal = self.dropout_signal(out_signal)
+        out_signal = self.relu_signal(out_signal)
+        return out_signal
+
+    @torch.jit.unused
+    def _both_forward_streams(self, kmer, base_means, base_stds, base_signal_lens,
+                              signals) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        seq and signal features are independent, run them on two cuda streams so that they can overlap
+        """
+        if self._streams is None:
+            self._streams = (torch.cuda.Stream(), torch.cuda.Stream())
+        stream_seq, stream_signal = self._streams
+        curr_stream = torch.cuda.current_stream()
+        # inputs are produced on the current stream
+        stream_seq.wait_stream(curr_stream)
+        stream_signal.wait_stream(curr_stream)
+        with torch.cuda.stream(stream_seq):
+            out_seq = self._seq_forward(kmer, base_means, base_stds, base_signal_lens)
+        with torch.cuda.stream(stream_signal):
+            out_signal = self._signal_forward(signals)
+        curr_stream.wait_stream(stream_seq)
+        curr_stream.wait_stream(stream_signal)
+        # tensors used across streams, keep the caching allocator from reusing their memory too early
+        for x in (kmer, base_means, base_stds, base_signal_lens):
+            x.record_stream(stream_seq)
+        signals.record_stream(stream_signal)
+        out_seq.record_stream(curr_stream)
+        out_signal.record_stream(curr_stream)
+        return out_seq, out_signal
+
+    def forward(self, kmer, base_means, base_stds, base_signal_lens, signals):
+        if not torch.jit.is_scripting():
+            if self.lstm_seq is not None and self.lstm_signal is not None and signals.is_cuda:
+                out_seq, out_signal = self._both_forward_streams(kmer, base_means, base_stds, base_signal_lens,
+                                                                 signals)
+                return self._comb_forward(torch.cat((out_seq, out_signal), 2))  # (N, L, hidden_size)
 
+        outs: List[torch.Tensor] = []
+        # seq feature ============================================
+        if self.lstm_seq is not None:
+            outs.append(self._seq_forward(kmer, base_means, base_stds, base_signal_lens))
         # signal feature ==========================================
-        # sgianls (L*C)
-        if self.module != "seq_bilstm":
-            out_signal = signals.float()
-            # resnet ---
-            # out_signal = out_signal.transpose(1, 2)  # (N, C, L)
-            # out_signal = self.convs(out_signal)  # (N, nhid_signal, L)
-            # out_signal = out_signal.transpose(1, 2)  # (N, L, nhid_signal)
-            # lstm ---
-            out_signal, _ = self.lstm_signal(out_signal, self.init_hidden(out_signal.size(0),
-                                                                          self.num_layers2,
-                                                                          self.nhid_signal))
-            out_signal = self.fc_signal(out_signal)  # (N, L, nhid_signal)
-            # out_signal = self.dropout_signal(out_signal)
-            out_signal = self.relu_signal(out_signal)
+        if self.lstm_signal is not None:
+            outs.append(self._signal_forward(signals))
+        out = outs[0] if len(outs) == 1 else torch.cat(outs, 2)  # (N, L, hidden_size)
+        return self._comb_forward(out)
 
+    def _comb_forward(self, out):
         # combined ================================================
-        if self.module == "seq_bilstm":
-            out = out_seq
-        elif self.module == "signal_bilstm":
-            out = out_signal
-        elif self.module == "both_bilstm":
-            out = torch.cat((out_seq, out_signal), 2)  # (N, L, hidden_size)
         out, _ = self.lstm_comb(out, self.init_hidden(out.size(0),
                                                       self.num_layers1,
-                                                      self.hidden_size))  # (N, L, hidden_size*2)
+                                                      self.hidden_size,
+                                                      out.device))  # (N, L, hidden_size*2)
         out_fwd_last = out[:, -1, :self.hidden_size]
         out_bwd_last = out[:, 0, self.hidden_size:]
         out = torch.cat((out_fwd_last, out_bwd_last), 1)
@@ -2,23 +2,137 @@
 import torch
 import torch.nn as nn
 from torch.optim.lr_scheduler import StepLR
-from sklearn import metrics
-import numpy as np
 import argparse
+import concurrent.futures
+import inspect
 import os
 import sys
 import time
-import re
+from pathlib import Path
 
 from .models import ModelBiLSTM
 from .dataloader import SignalFeaData2
 from .dataloader import clear_linecache
+from .dataloader import signal_collate
 from .utils.process_utils import display_args
 from .utils.process_utils import str2bool
+from .utils.process_utils import positive_int
 
 from .utils.constants_torch import use_cuda
 
 
+class _NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *excinfo):
+        return False
+
+
+def _autocast(enabled, dtype):
+    """
+    autocast context for mixed precision, a null context when amp is disabled
+    :param enabled:
+    :param dtype: torch.float16 or torch.bfloat16
+    :return:
+    """
+    if not enabled:
+        return _NullContext()
+    if dtype == torch.float16:
+        return torch.cuda.amp.autocast()
+    return torch.cuda.amp.autocast(dtype=dtype)
+
+
+def _inference_mode():
+    # torch.inference_mode (torch>=1.9) also skips version counter tracking, no_grad for older torch
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def _dataloader_kwargs(args):
+    """
+    DataLoader kwargs for parallel loading of SignalBatch into pinned memory,
+    persistent_workers/prefetch_factor need torch>=1.7 and num_workers>0
+    :param args:
+    :return:
+    """
+    kwargs = {"num_workers": args.num_workers, "pin_memory": use_cuda, "collate_fn": signal_collate}
+    if args.num_workers > 0 and \
+            "persistent_workers" in inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+        kwargs["persistent_workers"] = True
+        kwargs["prefetch_factor"] = args.prefetch_factor
+    return kwargs
+
+
+def _accuracy_precision_recall(vcounts, vtotal):
+    """
+    metrics of binary classification, same as sklearn.metrics (0 when ill-defined)
+    :param vcounts: tensor of [tp, fp, fn, correct], accumulated on device
+    :param vtotal: number of samples
+    :return: accuracy, precision, recall
+    """
+    tp, fp, fn, correct = vcounts.tolist()  # the only device->host sync
+    accuracy = float(correct) / vtotal if vtotal > 0 else 0.
+    precision = float(tp) / (tp + fp) if tp + fp > 0 else 0.
+    recall = float(tp) / (tp + fn) if tp + fn > 0 else 0.
+    return accuracy, precision, recall
+
+
+def _evaluate(eval_model, valid_loader, criterion, use_amp, amp_dtype):
+    """
+    validate the model, model.eval() should be called before
+    :param eval_model:
+    :param valid_loader:
+    :param criterion:
+    :param use_amp:
+    :param amp_dtype:
+    :return: valid loss, accuracy, precision, recall
+    """
+    with _inference_mode():
+        # loss sum and [tp, fp, fn, correct] are accumulated on device, synced once after the loop
+        vlosses_sum = torch.zeros((), device="cuda" if use_cuda else "cpu")
+        vlosses_n = 0
+        vcounts = torch.zeros(4, dtype=torch.long, device="cuda" if use_cuda else "cpu")
+        vtotal = 0
+        for vsfeatures in valid_loader:
+            if use_cuda:
+                vsfeatures = vsfeatures.to("cuda", non_blocking=True)
+            _, vkmer, vbase_means, vbase_stds, vbase_signal_lens, vsignals, vlabels = vsfeatures
+            with _autocast(use_amp, amp_dtype):
+                voutputs, vlogits = eval_model(vkmer, vbase_means, vbase_stds, vbase_signal_lens, vsignals)
+                vloss = criterion(voutputs, vlabels)
+
+            _, vpredicted = torch.max(vlogits.data, 1)
+
+            vlosses_sum += vloss.detach().float()
+            vlosses_n += 1
+            vpos, vtrue = vpredicted == 1, vlabels == 1
+            vcounts += torch.stack(((vpos & vtrue).sum(), (vpos & ~vtrue).sum(),
+                                    (~vpos & vtrue).sum(), (vpredicted == vlabels).sum()))
+            vtotal += vlabels.size(0)
+
+        v_accuracy, v_precision, v_recall = _accuracy_precision_recall(vcounts, vtotal)
+        v_loss = (vlosses_sum / max(vlosses_n, 1)).item()
+    return v_loss, v_accuracy, v_precision, v_recall
+
+
+def _save_model_async(executor, model, model_path, prev_future=None):
+    """
+    snapshot the state_dict to cpu, and write it to disk in executor's thread
+    :param executor: concurrent.futures.ThreadPoolExecutor
+    :param model:
+    :param model_path:
+    :param prev_future: future of the previous save, its exceptions are raised here
+    :return: future of this save
+    """
+    if prev_future is not None:
+        prev_future.result()
+    # blocking copy, so the snapshot is complete before optimizer steps modify the parameters
+    cpu_state = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+    return executor.submit(torch.save, cpu_state, model_path)
+
+
 def train(args):
     """
 
@@ -35,28 +149,57 @@ def train(args):
         print("GPU is not available!")
 
     print("reading data..")
+    loader_kwargs = _dataloader_kwargs(args)
     train_dataset = SignalFeaData2(args.train_file)
     train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                batch_size=args.batch_size,
-                                               shuffle=True)
+                                               shuffle=True,
+                                               drop_last=True,
+                                               **loader_kwargs)
 
     valid_dataset = SignalFeaData2(args.valid_file)
+    valid_batch_size = args.valid_batch_size if args.valid_batch_size is not None else args.batch_size
+    # keep valid_loader unshuffled: metrics do not depend on sample order, and the file is read sequentially
     valid_loader = torch.utils.data.DataLoader(dataset=valid_dataset,
-                                               batch_size=args.batch_size,
-                                               shuffle=False)
+                                               batch_size=valid_batch_size,
+                                               shuffle=False,
+                                               **loader_kwargs)
+    # a fixed random subset of the valid set for the intra-epoch checks, sampled once with a fixed seed,
+    # so that every check sees the same samples from all over the valid file
+    subvalid_loader = valid_loader
+    subvalid_num = args.valid_steps_per_check * valid_batch_size
+    if 0 < subvalid_num < len(valid_dataset):
+        generator = torch.Generator()
+        generator.manual_seed(1234)
+        subvalid_idxs = torch.randperm(len(valid_dataset), generator=generator)[:subvalid_num]
+        # sorted, so that the subset is still read in file order
+        subvalid_idxs = torch.sort(subvalid_idxs)[0].tolist()
+        subvalid_loader = torch.utils.data.DataLoader(dataset=torch.utils.data.Subset(valid_dataset,
+                                                                                      subvalid_idxs),
+                                                      batch_size=valid_batch_size,
+                                                      shuffle=False,
+                                                      **loader_kwargs)
 
     model_dir = args.model_dir
-    model_regex = re.compile(r"" + args.model_type + "\.b\d+_s\d+_epoch\d+\.ckpt*")
     if model_dir != "/":
         model_dir = os.path.abspath(model_dir).rstrip("/")
-        if not os.path.exists(model_dir):
-            os.makedirs(model_dir)
-        else:
-            for mfile in os.listdir(model_dir):
-                if model_regex.match(mfile):
-                    os.remove(model_dir + "/" + mfile)
+        mdir = Path(model_dir)
+        mdir.mkdir(parents=True, exist_ok=True)
+        # remove old checkpoints of this model_type
+        for mfile in mdir.glob(args.model_type + ".b*_s*_epoch*.ckpt"):
+            mfile.unlink()
         model_dir += "/"
 
+    # input shapes are fixed (seq_len, signal_len, drop_last), let cudnn cache the fastest algorithms;
+    # use TF32 for fp32 matmul/cudnn on Ampere or newer GPUs
+    if use_cuda:
+        torch.backends.cudnn.benchmark = True
+        if hasattr(torch.backends.cuda, "matmul"):
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        if hasattr(torch, "set_float32_matmul_precision"):
+            torch.set_float32_matmul_precision("high")
+
     model = ModelBiLSTM(args.seq_len, args.signal_len, args.layernum1, args.layernum2, args.class_num,
                         args.dropout_rate, args.hid_rnn,
                         args.n_vocab, args.n_embed, str2bool(args.is_base), str2bool(args.is_signallen),
@@ -64,13 +207,40 @@ def train(args):
     if use_cuda:
         model = model.cuda()
 
+    # compile the training forward (torch>=2.0), its batch shape is fixed by drop_last. validation uses the
+    # eager model, so eval mode, --valid_batch_size and the last partial valid batch cause no recompilation.
+    # compiled_model shares modules/parameters with model, train()/eval() and state_dict() are still called
+    # on model, so saved checkpoints keep their keys
+    compiled_model = model
+    if use_cuda and str2bool(args.use_compile) and hasattr(torch, "compile"):
+        compiled_model = torch.compile(model, dynamic=False)
+        print("using torch.compile for training")
+
+    # TorchScript model for validation, it shares parameters with model, so no re-scripting is needed
+    # after optimizer steps. falls back to the eager model if scripting fails
+    eval_model = model
+    if str2bool(args.jit_eval):
+        try:
+            eval_model = torch.jit.script(model)
+            eval_model.eval()
+            print("using TorchScript model for validation")
+        except Exception as e:
+            eval_model = model
+            print("torch.jit.script failed ({}: {}), using eager model for validation".format(
+                type(e).__name__, str(e).strip().split("\n")[0]))
+
     # Loss and optimizer
-    weight_rank = torch.from_numpy(np.array([1, args.pos_weight])).float()
-    if use_cuda:
-        weight_rank = weight_rank.cuda()
+    weight_rank = torch.tensor([1.0, args.pos_weight], dtype=torch.float32,
+                               device="cuda" if use_cuda else "cpu")
     criterion = nn.CrossEntropyLoss(weight=weight_rank)
+    if use_cuda:
+        criterion = criterion.cuda()
     if args.optim_type == "Adam":
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        # fused kernel for all parameters (torch>=2.0, cuda only)
+        adam_kwargs = {}
+        if use_cuda and "fused" in inspect.signature(torch.optim.Adam.__init__).parameters:
+            adam_kwargs["fused"] = True
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, **adam_kwargs)
     elif args.optim_type == "RMSprop":
         optimizer = torch.optim.RMSprop(model.parameters(), lr=args.lr)
     elif args.optim_type == "SGD":
@@ -87,93 +257,105 @@ def train(args):
     else:
         raise ValueError("optim_type is not right!")
     scheduler = StepLR(optimizer, step_size=args.lr_decay_step, gamma=args.lr_decay)
+    # set grads to None instead of zero-filling them, torch>=1.7
+    zero_grad_kwargs = {}
+    if "set_to_none" in inspect.signature(optimizer.zero_grad).parameters:
+        zero_grad_kwargs["set_to_none"] = True
+
+    # mixed precision, bf16 if supported (no loss scaling needed), else fp16 with GradScaler
+    use_amp = use_cuda and str2bool(args.use_amp) and hasattr(torch.cuda, "amp")
+    amp_dtype = torch.float16
+    if use_amp and hasattr(torch.cuda, "is_bf16_supported") and torch.cuda.is_bf16_supported():
+        amp_dtype = torch.bfloat16
+    scaler = None
+    if use_amp and amp_dtype == torch.float16:
+        scaler = torch.cuda.amp.GradScaler()
+    if use_amp:
+        print("using amp, dtype: {}".format(amp_dtype))
 
     # Train the model
     total_step = len(train_loader)
     print("total_step: {}".format(total_step))
+    # the last accumulation window of an epoch is shorter when total_step % grad_accum_steps != 0,
+    # it still takes an optimizer step, with its loss averaged over its own size
+    last_window_start = total_step - total_step % args.grad_accum_steps
     curr_best_accuracy = 0
+    # checkpoints are written in a background thread, so training is not blocked by disk I/O
+    save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_future = None
     model.train()
     # train at most max_epoch_num epochs
     for epoch in range(args.max_epoch_num):
-        curr_best_accuracy_epoch = 0
-        tlosses = []
+        # train loss is accumulated on device, to avoid a sync with .item() every step
+        tlosses_sum = torch.zeros((), device="cuda" if use_cuda else "cpu")
+        tlosses_n = 0
         start = time.time()
+        optimizer.zero_grad(**zero_grad_kwargs)
         for i, sfeatures in enumerate(train_loader):
-            _, kmer, base_means, base_stds, base_signal_lens, signals, labels = sfeatures
             if use_cuda:
-                kmer = kmer.cuda()
-                base_means = base_means.cuda()
-                base_stds = base_stds.cuda()
-                base_signal_lens = base_signal_lens.cuda()
-                signals = signals.cuda()
-                labels = labels.cuda()
+                sfeatures = sfeatures.to("cuda", non_blocking=True)
+            _, kmer, base_means, base_stds, base_signal_lens, signals, labels = sfeatures
 
             # Forward pass
-            outputs, logits = model(kmer, base_means, base_stds, base_signal_lens, signals)
-            loss = criterion(outputs, labels)
-            tlosses.append(loss.detach().item())
-
-            # Backward and optimize
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-            optimizer.step()
+            with _autocast(use_amp, amp_dtype):
+                outputs, logits = compiled_model(kmer, base_means, base_stds, base_signal_lens, signals)
+                loss = criterion(outputs, labels)
+            tlosses_sum += loss.detach().float()
+            tlosses_n += 1
+
+            # Backward and optimize, gradients are accumulated over grad_accum_steps batches
+            accum_num = args.grad_accum_steps if i < last_window_start else total_step - last_window_start
+            if scaler is not None:
+                scaler.scale(loss / accum_num).backward()
+            else:
+                (loss / accum_num).backward()
+            if (i + 1) % args.grad_accum_steps == 0 or i + 1 == total_step:
+                if scaler is not None:
+                    # unscale before clipping, so the threshold applies to the true gradients
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+                    optimizer.step()
+                optimizer.zero_grad(**zero_grad_kwargs)
 
             if (i + 1) % args.step_interval == 0:
+                # intra-epoch check on the random subset of the valid set only
                 model.eval()
-                with torch.no_grad():
-                    vlosses, vlabels_total, vpredicted_total = [], [], []
-                    for vi, vsfeatures in enumerate(valid_loader):
-                        _, vkmer, vbase_means, vbase_stds, vbase_signal_lens, vsignals, vlabels = vsfeatures
-                        if use_cuda:
-                            vkmer = vkmer.cuda()
-                            vbase_means = vbase_means.cuda()
-                            vbase_stds = vbase_stds.cuda()
-                            vbase_signal_lens = vbase_signal_lens.cuda()
-                            vsignals = vsignals.cuda()
-                            vlabels = vlabels.cuda()
-                        voutputs, vlogits = model(vkmer, vbase_means, vbase_stds, vbase_signal_lens, vsignals)
-                        vloss = criterion(voutputs, vlabels)
-
-                        _, vpredicted = torch.max(vlogits.data, 1)
-
-                        if use_cuda:
-                            vlabels = vlabels.cpu()
-                            vpredicted = vpredicted.cpu()
-                        # i_accuracy = metrics.accuracy_score(vlabels.numpy(), vpredicted)
-                        # i_precision = metrics.precision_score(vlabels.numpy(), vpredicted)
-                        # i_recall = metrics.recall_score(vlabels.numpy(), vpredicted)
-
-                        # vaccus.append(i_accuracy)
-                        # vprecs.append(i_precision)
-                        # vrecas.append(i_recall)
-                        vlosses.append(vloss.item())
-                        vlabels_total += vlabels
-                        vpredicted_total += vpredicted
-
-                    v_accuracy = metrics.accuracy_score(vlabels_total, vpredicted_total)
-                    v_precision = metrics.precision_score(vlabels_total, vpredicted_total)
-                    v_recall = metrics.recall_score(vlabels_total, vpredicted_total)
-                    if v_accuracy > curr_best_accuracy_epoch:
-                        curr_best_accuracy_epoch = v_accuracy
-                        if curr_best_accuracy_epoch > curr_best_accuracy - 0.0005:
-                            torch.save(model.state_dict(),
-                                       model_dir + args.model_type + '.b{}_s{}_epoch{}.ckpt'.format(args.seq_len,
-                                                                                                    args.signal_len,
-                                                                                                    epoch + 1))
-
-                    time_cost = time.time() - start
-                    print('Epoch [{}/{}], Step [{}/{}], TrainLoss: {:.4f}; '
-                          'ValidLoss: {:.4f}, '
-                          'Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}, '
-                          'curr_epoch_best_accuracy: {:.4f}; Time: {:.2f}s'
-                          .format(epoch + 1, args.max_epoch_num, i + 1, total_step, np.mean(tlosses),
-                                  np.mean(vlosses), v_accuracy, v_precision, v_recall,
-                                  curr_best_accuracy_epoch, time_cost))
-                    tlosses = []
-                    start = time.time()
-                    sys.stdout.flush()
+                v_loss, v_accuracy, v_precision, v_recall = _evaluate(eval_model, subvalid_loader, criterion,
+                                                                      use_amp, amp_dtype)
+                t_loss = (tlosses_sum / tlosses_n).item()
+                time_cost = time.time() - start
+                print('Epoch [{}/{}], Step [{}/{}], TrainLoss: {:.4f}; '
+                      'ValidLoss: {:.4f}, '
+                      'Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}; Time: {:.2f}s'
+                      .format(epoch + 1, args.max_epoch_num, i + 1, total_step, t_loss,
+                              v_loss, v_accuracy, v_precision, v_recall, time_cost))
+                tlosses_sum.zero_()
+                tlosses_n = 0
+                start = time.time()
+                sys.stdout.flush()
                 model.train()
+
+        # validate on the whole valid set at the end of each epoch, to decide checkpoint saving
+        model.eval()
+        v_loss, v_accuracy, v_precision, v_recall = _evaluate(eval_model, valid_loader, criterion,
+                                                              use_amp, amp_dtype)
+        curr_best_accuracy_epoch = v_accuracy
+        if curr_best_accuracy_epoch > curr_best_accuracy - 0.0005:
+            save_future = _save_model_async(save_executor, model,
+                                            model_dir + args.model_type +
+                                            '.b{}_s{}_epoch{}.ckpt'.format(args.seq_len, args.signal_len,
+                                                                           epoch + 1),
+                                            save_future)
+        print('Epoch [{}/{}] done, ValidLoss: {:.4f}, '
+              'Accuracy: {:.4f}, Precision: {:.4f}, Recall: {:.4f}; Time: {:.2f}s'
+              .format(epoch + 1, args.max_epoch_num, v_loss, v_accuracy, v_precision, v_recall,
+                      time.time() - start))
+        sys.stdout.flush()
+        model.train()
         scheduler.step()
         if curr_best_accuracy_epoch > curr_best_accuracy:
             curr_best_accuracy = curr_best_accuracy_epoch
@@ -182,6 +364,9 @@ def train(args):
                 print("best accuracy: {}, early stop!".format(curr_best_accuracy))
                 break
 
+    save_executor.shutdown(wait=True)
+    if save_future is not None:
+        save_future.result()
     endtime = time.time()
     clear_linecache()
     print("[train] training cost {} seconds".format(endtime - total_start))
@@ -230,6 +415,12 @@ def main():
                         required=False, help="type of optimizer to use, 'Adam' or 'SGD' or 'RMSprop' or 'Ranger', "
                                              "default Adam")
     parser.add_argument('--batch_size', type=int, default=512, required=False)
+    parser.add_argument('--valid_batch_size', type=int, default=None, required=False,
+                        help="batch size of validation, no gradients are kept in validation so it can be larger "
+                             "than --batch_size. default the same as --batch_size")
+    parser.add_argument('--grad_accum_steps', type=positive_int, default=1, required=False,
+                        help="number of batches to accumulate gradients over before each optimizer step, "
+                             "the effective batch size is batch_size*grad_accum_steps. default 1")
     parser.add_argument('--lr', type=float, default=0.001, required=False)
     parser.add_argument('--lr_decay', type=float, default=0.1, required=False)
     parser.add_argument('--lr_decay_step', type=int, default=2, required=False)
@@ -238,8 +429,24 @@ def main():
     parser.add_argument("--min_epoch_num", action="store", default=5, type=int,
                         required=False, help="min epoch num, default 5")
     parser.add_argument('--step_interval', type=int, default=100, required=False)
+    parser.add_argument('--valid_steps_per_check', type=int, default=20, required=False,
+                        help="size (in batches) of the random valid subset, sampled once at start, used in "
+                             "each check every step_interval steps. the whole valid set is used at the end of "
+                             "each epoch. 0 for the whole valid set in each check, default 20")
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count() or 1), required=False,
+                        help="number of subprocesses used by DataLoader, default min(8, cpu_count)")
+    parser.add_argument('--prefetch_factor', type=int, default=4, required=False,
+                        help="number of batches loaded in advance by each DataLoader worker, default 4")
 
     parser.add_argument('--pos_weight', type=float, default=1.0, required=False)
+    parser.add_argument('--use_compile', type=str, default="no", required=False,
+                        help="use torch.compile on the model for training (needs torch>=2.0 and GPU, "
+                             "not available in the torch range of requirements.txt), default no")
+    parser.add_argument('--jit_eval', type=str, default="no", required=False,
+                        help="use a TorchScript copy of the model for validation, default no")
+    parser.add_argument('--use_amp', type=str, default="yes", required=False,
+                        help="use automatic mixed precision (bf16 if supported, else fp16) when training "
+                             "on GPU, default yes")
     # parser.add_argument('--seed', type=int, default=1234,
     #                     help='random seed')
 
@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import argparse
 import fnmatch
 import os
 import random
@@ -45,6 +46,14 @@ def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
 
+def positive_int(v):
+    # argparse type for int args which must be >= 1
+    iv = int(v)
+    if iv < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive int".format(v))
+    return iv
+
+
 def _alphabet(letter, dbasepairs):
     if letter in dbasepairs.keys():
         return dbasepairs[letter]